@@ -1,13 +1,54 @@
 '''Flickr keys and params'''
 FLICKR_PUBLIC = 'YOUR FLICKR PUBLIC KEY'
 FLICKR_SECRET = 'YOUR FLICKR PRIVATE KEY'
+FLICKR_REST_URL = 'https://api.flickr.com/services/rest/'
+flickr_search_method = 'flickr.photos.search'
 
-# comma-separated string containing extra information to be retrieved for the photos, used here to get geo information
+# maximum number of pages fetched from Flickr at the same time, split evenly between the worker processes. It bounds the
+# concurrency of the requests, not their rate
+max_concurrent_pages = 20
+
+# HTTP session params: timeouts in seconds, size of the connection pool and how long idle connections are kept alive
+http_total_timeout = 30
+http_connect_timeout = 5
+http_max_connections = 200
+http_max_connections_per_host = 30
+http_keepalive_timeout = 60
+
+# comma-separated string containing extra information to be retrieved for the photos, used here to get geo information.
+# Only the extras that are stored should be listed since every extra adds its fields to each of the photos in a page,
+# the default fields of a photo such as owner, secret and server cannot be turned off in Flickr API
 extras = 'geo'
 
 BING_MAPS_API_KEY = 'YOUR BING MAPS API KEY'
+# number of threads running the blocking Bing Maps requests of a process, that is, the number of different locations
+# geocoded at the same time
+geocode_max_workers = 4
+# seconds during which a location that could not be geocoded because Bing Maps kept failing is not tried again
+geocode_failure_ttl = 60
+
+# number of attempts for Flickr and Bing Maps requests failing transiently and the delay in seconds before the first
+# retry, which doubles on every following retry
+max_attempts = 5
+retry_backoff = 0.25
+# Flickr API error codes, returned with HTTP status 200, which are transient: 10 search API not currently available,
+# 105 service currently unavailable
+flickr_retryable_error_codes = [10, 105]
 
 '''DB params'''
 db_name = 'scraper.db'
 image_metadata_table = 'image_metadata'
 default_geo_info_table ='default_geo_info'
+# maximum number of values bound to a single query, the default limit of SQLite versions before 3.32
+db_max_variables = 999
+
+# PRAGMAs applied on every connection: WAL lets readers and the writer work concurrently, synchronous=NORMAL is safe
+# with WAL and avoids an fsync per commit, and the remaining ones enlarge the page cache and memory-map the database
+db_pragmas = [
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'cache_size=-1048576',
+    'temp_store=MEMORY',
+    'mmap_size=268435456',
+    'foreign_keys=ON'
+]
@@ -1,4 +1,8 @@
+import multiprocessing
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
 from sqlite3 import Error
 
 from scrape_flickr import config
@@ -11,73 +15,151 @@ Author: Shruti Rachh
 
 class DBUtils:
     '''
-    This class provides methods to create, insert and get data from SQLite database
+    This class provides methods to create, insert and get data from SQLite database.
+    It keeps a single write connection, whose use is serialized by a lock, and a pool of read connections that can
+    be used concurrently, following the one writer and many readers model of SQLite in WAL mode.
     '''
 
-    def __init__(self, db_name):
+    def __init__(self, db_name, no_of_readers=None):
         '''
-        Initializes the database name
+        Initializes the database name and the connection pools, connections are opened lazily on first use
         :param db_name: name of database, example, scraper.db
+        :param no_of_readers: maximum number of read connections, defaults to the number of processors
         '''
         self.db_name = db_name
+        self.no_of_readers = no_of_readers or multiprocessing.cpu_count()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.readers = queue.Queue()
+        self.no_of_open_readers = 0
+        self.readers_lock = threading.Lock()
 
     def create_db_connection(self):
         '''
-        Creates database connection
+        Creates database connection configured with the PRAGMAs listed in config.
+        The connection is in autocommit mode, write transactions are started explicitly.
         :return: connection object if successful, otherwise returns None
         '''
         try:
-            conn = sqlite3.connect(self.db_name, timeout=30)
+            conn = sqlite3.connect(self.db_name, timeout=30, isolation_level=None, check_same_thread=False)
+            for pragma in config.db_pragmas:
+                conn.execute('PRAGMA ' + pragma)
             return conn
         except Error:
             print('Connection Failed!')
         return None
 
+    @contextmanager
+    def reader_connection(self):
+        '''
+        Checks out a read connection from the pool, opening a new one while below the limit, otherwise waiting for
+        one to be returned
+        :return: connection object if successful, otherwise returns None
+        '''
+        conn = None
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            with self.readers_lock:
+                if self.no_of_open_readers < self.no_of_readers:
+                    conn = self.create_db_connection()
+                    if conn:
+                        self.no_of_open_readers += 1
+            if conn is None and self.no_of_open_readers:
+                conn = self.readers.get()
+        try:
+            yield conn
+        finally:
+            if conn:
+                self.readers.put(conn)
+
+    @contextmanager
+    def writer_connection(self):
+        '''
+        Acquires the single write connection, opening it on first use
+        :return: connection object if successful, otherwise returns None
+        '''
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = self.create_db_connection()
+            yield self.writer
+
+    def close(self):
+        '''
+        Closes the write connection and the read connections in the pool
+        '''
+        with self.writer_lock:
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+        with self.readers_lock:
+            while self.no_of_open_readers:
+                self.readers.get().close()
+                self.no_of_open_readers -= 1
+
     def create_db_tables(self):
         '''
         Creates database tables to store the image metadata and default geo locations.
+        The default geo locations are kept from previous runs so that they are not geocoded again.
         '''
-        conn = self.create_db_connection()
-        if conn:
-            cur = conn.cursor()
-            cur.execute('DROP TABLE IF EXISTS ' + config.image_metadata_table)
-            cur.execute('DROP TABLE IF EXISTS ' + config.default_geo_info_table)
-            cur.execute('CREATE TABLE ' + config.image_metadata_table +
-                        '(id TEXT PRIMARY KEY, filename TEXT, latitude NUMBER, longitude NUMBER)')
-            cur.execute('CREATE TABLE ' + config.default_geo_info_table +
-                        '(search_text TEXT PRIMARY KEY, latitude NUMBER, longitude NUMBER)')
-            conn.commit()
-            conn.close()
+        with self.writer_connection() as conn:
+            if conn:
+                cur = conn.cursor()
+                cur.execute('DROP TABLE IF EXISTS ' + config.image_metadata_table)
+                cur.execute('CREATE TABLE ' + config.image_metadata_table +
+                            '(id INTEGER PRIMARY KEY, filename TEXT, latitude REAL, longitude REAL)')
+                cur.execute('CREATE TABLE IF NOT EXISTS ' + config.default_geo_info_table +
+                            '(search_text TEXT PRIMARY KEY, latitude REAL, longitude REAL)')
 
-    def get_data(self, table_name, param_name, param_value):
+    def get_all(self, table_name):
         '''
-        Gets data from database given the primary key name and value
+        Gets all the rows of a table
         :param table_name: name of the table to fetch data from
-        :param param_name: primary key name
-        :param param_value: primary key value
         :returns data as a list if present, otherwise an empty list
         '''
-        conn = self.create_db_connection()
         rows = []
-        if conn:
-            sql = "SELECT * from " + table_name + " WHERE " + param_name + "='" + param_value + "'"
-            cur = conn.cursor()
-            cur.execute(sql)
-            rows = cur.fetchall()
-            conn.close()
+        with self.reader_connection() as conn:
+            if conn:
+                cur = conn.cursor()
+                cur.execute('SELECT * from ' + table_name)
+                rows = cur.fetchall()
         return rows
 
-    def insert_data(self, table_name, values):
+    def get_existing_keys(self, table_name, param_name, param_values):
         '''
-        Inserts data into database given the table name and values
+        Gets which of the given primary key values are already present in the table using a single query, split into
+        batches of config.db_max_variables values to stay within the limit on query parameters of SQLite
+        :param table_name: name of the table to look up
+        :param param_name: primary key name
+        :param param_values: list of primary key values
+        :returns set of the given primary key values that are present in the table
+        '''
+        keys = set()
+        if not param_values:
+            return keys
+        with self.reader_connection() as conn:
+            if conn:
+                cur = conn.cursor()
+                for start in range(0, len(param_values), config.db_max_variables):
+                    batch = param_values[start:start + config.db_max_variables]
+                    placeholders = ",".join(['?']*len(batch))
+                    sql = 'SELECT {} from {} WHERE {} IN ({})'.format(param_name, table_name, param_name, placeholders)
+                    cur.execute(sql, batch)
+                    keys.update(row[0] for row in cur.fetchall())
+        return keys
+
+    def insert_many(self, table_name, rows):
+        '''
+        Inserts multiple rows into database in a single transaction
         :param table_name: name of table to insert data into
-        :param values: tuple containing list of values of the columns
-        '''
-        conn = self.create_db_connection()
-        if conn:
-            placeholders = ",".join(['?']*len(values))
-            sql = 'INSERT OR IGNORE into {} values({})'.format(table_name, placeholders)
-            cur = conn.cursor()
-            cur.execute(sql, values)
-            conn.commit()
-            conn.close()
+        :param rows: list of tuples, each containing the values of the columns
+        '''
+        if not rows:
+            return
+        with self.writer_connection() as conn:
+            if conn:
+                placeholders = ",".join(['?']*len(rows[0]))
+                sql = 'INSERT OR IGNORE into {} values({})'.format(table_name, placeholders)
+                with conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.executemany(sql, rows)
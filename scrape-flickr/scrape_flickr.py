@@ -1,10 +1,21 @@
 #!/usr/bin/env python
-from flickrapi import FlickrAPI
+import aiohttp
+import asyncio
+from aiomultiprocess import Pool
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import geocoder
+import orjson
 
 import multiprocessing
-from multiprocessing import pool
-from functools import partial
+import queue
+import random
+
+try:
+    import uvloop
+except ImportError:
+    # uvloop is not available on Windows, the default asyncio event loop is used instead
+    uvloop = None
 
 import config
 import db_utils
@@ -33,17 +44,65 @@ Author: Shruti Rachh
 '''
 
 
+class FlickrError(Exception):
+    '''
+    This class represents an error reported by Flickr API in the body of a response with stat 'fail'
+    '''
+
+    def __init__(self, code, message):
+        '''
+        Initializes the error with the code and message returned by Flickr API
+        :param code: error code returned by Flickr API
+        :param message: error message returned by Flickr API
+        '''
+        super().__init__('Error: {}: {}'.format(code, message))
+        self.code = code
+        self.message = message
+
+
+def normalize_search_text(search_text):
+    '''
+    Normalizes the search text so that different spellings of the same location such as "Paris" and "paris " match
+    :param search_text: text that was searched
+    :return: lowercase search text with whitespace collapsed
+    '''
+    return ' '.join(search_text.lower().split())
+
+
+def is_retryable_status(status_code):
+    '''
+    Checks whether a failed request is worth retrying, that is, when no response was received, the server failed or
+    the request was rate limited
+    :param status_code: HTTP status code of the response, not an integer if no response was received
+    :return: True if the request should be retried, otherwise False
+    '''
+    return not isinstance(status_code, int) or status_code == 429 or status_code >= 500
+
+
+def get_backoff_delay(attempt):
+    '''
+    Gets the exponentially growing delay, with random jitter, to wait before retrying a failed request
+    :param attempt: number of the attempt that failed, starting from 0
+    :return: delay in seconds
+    '''
+    return config.retry_backoff * 2 ** attempt + random.random()
+
+
 class WebScraper:
     '''
-    This class provides functionality to scrape images with multiple searches all executing in parallel.
+    This class provides functionality to scrape images with multiple searches all executing concurrently, fetching
+    the pages of a search concurrently on the event loop.
     It uses Flickr API to get the images information and Bing Maps API to handle missing geo data.
     '''
 
-    def __init__(self, search_text_list, photos_per_page):
+    def __init__(self, search_text_list, photos_per_page, no_of_processes=1, write_queue=None):
         '''
-        Constructor to initialize the parameters needed by Flickr API to retrieve the images in parallel
+        Constructor to initialize the parameters needed by Flickr API to retrieve the images concurrently
         :param search_text_list: list of locations to be searched
         :param photos_per_page: number of photos to be retrieved at a time (MAX=500), a limit set by Flickr API
+        :param no_of_processes: number of processes scraping at the same time, which share config.max_concurrent_pages
+        :param write_queue: queue on which the rows to be inserted into database are sent to the writer, a local queue
+                            is used if not given
         '''
         self.search_text_list = set(search_text_list)
         if photos_per_page > 500:
@@ -51,9 +110,19 @@ class WebScraper:
         else:
             self.photos_per_page = photos_per_page
         self.extras = config.extras
-        self.flickr = FlickrAPI(config.FLICKR_PUBLIC, config.FLICKR_SECRET, format='parsed-json')
         self.no_of_processors = multiprocessing.cpu_count()
         self.dbutils = db_utils.DBUtils(config.db_name)
+        # Shared by all the searches of the process, which runs one slice of the searches, so that the number of pages
+        # being fetched is bounded per process
+        self.page_semaphore = asyncio.Semaphore(max(1, config.max_concurrent_pages // no_of_processes))
+        self.geo_cache = None
+        self.geo_cache_lock = asyncio.Lock()
+        # Geocoding in progress by normalized search text
+        self.geo_lookups = {}
+        # Expiry time of the geocoding failures by normalized search text
+        self.geo_failures = {}
+        self.geo_executor = ThreadPoolExecutor(max_workers=config.geocode_max_workers)
+        self.write_queue = write_queue if write_queue is not None else queue.Queue()
 
     def add_search_text(self, search_text):
         '''
@@ -117,85 +186,291 @@ class WebScraper:
         '''
         return self.dbutils
 
-    def get_missing_geo_data(self, search_text):
+    def close(self):
+        '''
+        Releases the database connections and the geocoding threads
+        '''
+        self.dbutils.close()
+        self.geo_executor.shutdown()
+
+    async def load_geo_cache(self):
+        '''
+        Loads all the default geo locations saved in database into the in-memory cache keyed by normalized search text,
+        reading them in a separate thread so that the event loop is not blocked
+        '''
+        rows = await asyncio.to_thread(self.dbutils.get_all, config.default_geo_info_table)
+        self.geo_cache = {normalize_search_text(row[0]): row for row in rows}
+
+    async def geocode(self, search_text):
+        '''
+        Geocodes the location using Bing Maps API on the geocoding thread pool so that the blocking request does not
+        stall the event loop, retrying transient failures with exponential backoff
+        :param search_text: location to be geocoded
+        :return: geocoder result, which is empty if the location could not be geocoded
         '''
-        Gets the missing geo data using Bing Maps API based on generic location that was searched.
-        Saves this data in database for future use.
+        for attempt in range(config.max_attempts):
+            matches = await asyncio.get_running_loop().run_in_executor(
+                self.geo_executor, partial(geocoder.bing, search_text, key=config.BING_MAPS_API_KEY))
+            if matches or not is_retryable_status(matches.status_code):
+                break
+            if attempt < config.max_attempts - 1:
+                await asyncio.sleep(get_backoff_delay(attempt))
+        return matches
+
+    async def lookup_geo_data(self, search_text):
+        '''
+        Geocodes the location using Bing Maps API, saving the result in the cache and queuing it to be written into
+        database for future use
+        :param search_text: normalized location that was searched
+        :return: a tuple (search_text, latitude, longitude), empty if the location could not be geocoded
+        '''
+        geo_data = ()
+        matches = await self.geocode(search_text)
+        if matches:
+            geo_info = matches.latlng
+            geo_data = (search_text, float(geo_info[0]), float(geo_info[1]))
+            await asyncio.to_thread(self.write_queue.put, (config.default_geo_info_table, [geo_data]))
+            self.geo_cache[search_text] = geo_data
+        elif not is_retryable_status(matches.status_code):
+            # Only a location not found by Bing Maps is cached for good
+            self.geo_cache[search_text] = geo_data
+        else:
+            # The retries were used up on transient failures, the later pages skip geocoding until the failure expires
+            self.geo_failures[search_text] = time.monotonic() + config.geocode_failure_ttl
+        return geo_data
+
+    async def get_missing_geo_data(self, search_text):
+        '''
+        Gets the missing geo data based on generic location that was searched, looking it up in the in-memory cache
+        loaded from database on first use, otherwise using Bing Maps API.
+        Saves this data in the cache and queues it to be written into database for future use.
         :param search_text: location that was searched
         :return: a tuple (search_text, latitude, longitude)
         '''
-        result = self.dbutils.get_data(config.default_geo_info_table, 'search_text', search_text)
-        if result:
-            return result[0]
-        else:
-            matches = geocoder.bing(search_text, key=config.BING_MAPS_API_KEY)
-            if matches:
-                geo_info = matches.latlng
-                params = (search_text, str(geo_info[0]), str(geo_info[1]))
-                self.dbutils.insert_data(config.default_geo_info_table, params)
-                return params
-        return ()
-
-    def insert_image_metadata_db(self, photo, search_text):
-        '''
-        Inserts image metadata such as id, filename and geo information into the sqlite database, if not already inserted.
-        :param photo: image data to be inserted
+        if self.geo_cache is None:
+            # Pages starting together wait for the first one to load the cache instead of each replacing it
+            async with self.geo_cache_lock:
+                if self.geo_cache is None:
+                    await self.load_geo_cache()
+        search_text = normalize_search_text(search_text)
+        if search_text in self.geo_cache:
+            return self.geo_cache[search_text]
+        if self.geo_failures.get(search_text, 0) > time.monotonic():
+            return ()
+        # Pages of the same search miss the cache together and wait for the lookup started by the first one, while the
+        # other search texts are looked up concurrently
+        lookup = self.geo_lookups.get(search_text)
+        if lookup is None:
+            lookup = asyncio.create_task(self.lookup_geo_data(search_text))
+            self.geo_lookups[search_text] = lookup
+            lookup.add_done_callback(lambda _: self.geo_lookups.pop(search_text, None))
+        # Shielded so that a page being cancelled does not cancel the lookup the other pages are waiting for
+        return await asyncio.shield(lookup)
+
+    async def insert_image_metadata_db(self, photos, search_text):
+        '''
+        Queues image metadata such as id, filename and geo information of a page of photos to be inserted into the
+        sqlite database by the writer, skipping the photos that are already inserted.
+        :param photos: list of image data to be inserted
         :param search_text: text that was searched used for the purpose of handling missing geo information
         '''
-        result = self.dbutils.get_data(config.image_metadata_table, 'id', photo['id'])
-        if not result:
-            if str(photo['latitude']) == '0' or str(photo['longitude']) == '0':
-                geo_data = self.get_missing_geo_data(search_text)
-                if geo_data:
+        ids = [int(photo['id']) for photo in photos]
+        # The lookup runs in a separate thread with its own read connection, so the pages look up their ids concurrently
+        existing_ids = await asyncio.to_thread(self.dbutils.get_existing_keys, config.image_metadata_table, 'id', ids)
+        new_photos = [photo for photo in photos if int(photo['id']) not in existing_ids]
+
+        # All the photos of a page share the search text, so the missing geo data is looked up once for the page
+        missing_geo_photos = [photo for photo in new_photos
+                              if float(photo['latitude']) == 0 or float(photo['longitude']) == 0]
+        if missing_geo_photos:
+            geo_data = await self.get_missing_geo_data(search_text)
+            if geo_data:
+                for photo in missing_geo_photos:
                     photo['latitude'] = geo_data[1]
                     photo['longitude'] = geo_data[2]
-            params = (str(photo['id']), str(photo['title']), str(photo['latitude']), str(photo['longitude']))
-            self.dbutils.insert_data(config.image_metadata_table, params)
+        rows = [(int(photo['id']), photo['title'], float(photo['latitude']), float(photo['longitude']))
+                for photo in new_photos]
+        if rows:
+            await asyncio.to_thread(self.write_queue.put, (config.image_metadata_table, rows))
+
+    def get_search_params(self, search_text, page_no=1):
+        '''
+        Builds the query parameters for the Flickr photos search REST call
+        :param search_text: text to be searched
+        :param page_no: page number to be retrieved
+        :return: dictionary of query parameters
+        '''
+        return {
+            'method': config.flickr_search_method,
+            'api_key': config.FLICKR_PUBLIC,
+            'text': search_text,
+            'per_page': self.photos_per_page,
+            'page': page_no,
+            'extras': self.extras,
+            'format': 'json',
+            'nojsoncallback': 1
+        }
 
-    def get_no_of_pages(self, search_text):
+    async def fetch_page(self, session, search_text, page_no=1):
         '''
-        Gets the number of pages for the given search text depending on the number of photos that are retrieved per page
+        Fetches a page of photos for the given search text from the Flickr REST API, retrying client errors such as
+        dropped connections, timeouts, server errors, rate limiting and Flickr API errors listed in
+        config.flickr_retryable_error_codes with exponential backoff. Each attempt holds one of the fetch slots of the
+        process, which is given back while waiting to retry.
+        :param session: aiohttp client session shared by all the requests
         :param search_text: text to be searched
-        :returns number of pages
+        :param page_no: page number to be retrieved
+        :return: the 'photos' part of the response containing the page count and list of photos
+        :raises FlickrError: if Flickr API reports an error, such as an invalid API key
         '''
-        return self.flickr.photos.search(text=search_text, per_page=self.photos_per_page, extras=self.extras)['photos']['pages']
+        params = self.get_search_params(search_text, page_no)
+        for attempt in range(config.max_attempts):
+            last_attempt = attempt == config.max_attempts - 1
+            try:
+                async with self.page_semaphore, session.get(config.FLICKR_REST_URL, params=params) as resp:
+                    if not is_retryable_status(resp.status) or last_attempt:
+                        resp.raise_for_status()
+                        data = orjson.loads(await resp.read())
+                        if data.get('stat') == 'ok':
+                            return data['photos']
+                        if data.get('code') not in config.flickr_retryable_error_codes or last_attempt:
+                            raise FlickrError(data.get('code'), data.get('message'))
+            except aiohttp.ClientResponseError:
+                # Raised for the HTTP errors which are not worth retrying
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if last_attempt:
+                    raise
+            await asyncio.sleep(get_backoff_delay(attempt))
 
-    def get_pages(self, search_text):
+    async def process_page(self, session, search_text, page_no):
         '''
-        Gets the pages for the given search text and processes the images in parallel
+        Fetches a page of photos and inserts their metadata into the database
+        :param session: aiohttp client session shared by all the requests
+        :param search_text: text to be searched
+        :param page_no: page number to be processed
+        '''
+        photos = (await self.fetch_page(session, search_text, page_no))['photo']
+        print('Collecting page ' + str(page_no) + ' image metadata for ' + search_text)
+        await self.insert_image_metadata_db(photos, search_text)
+
+    async def get_pages(self, session, search_text):
+        '''
+        Gets the pages for the given search text and processes them concurrently, sharing the bound on the number of
+        pages being fetched at a time with the other searches of the process
+        :param session: aiohttp client session shared by all the requests
         :param search_text: text to be searched
         '''
         print('Fetching images for ' + search_text)
-        no_of_pages = self.get_no_of_pages(search_text)
-        for page_no in range(1, no_of_pages):
-            photos = self.flickr.photos.search(text=search_text, per_page=self.photos_per_page, extras=self.extras,
-                                               page=page_no)['photos']['photo']
-            print('Collecting page ' + str(page_no) + ' image metadata for ' + search_text)
-            sub_process_pool = NoDaemonProcessPool(self.no_of_processors)
-            sub_process_pool.map(partial(self.insert_image_metadata_db, search_text=search_text), photos)
-            sub_process_pool.close()
-            sub_process_pool.join()
+        # The first page also tells the number of pages depending on the number of photos retrieved per page
+        first_page = await self.fetch_page(session, search_text)
+        print('Collecting page 1 image metadata for ' + search_text)
+        await self.insert_image_metadata_db(first_page['photo'], search_text)
+        async with asyncio.TaskGroup() as tg:
+            for page_no in range(2, first_page['pages'] + 1):
+                tg.create_task(self.process_page(session, search_text, page_no))
+
+
+def create_session():
+    '''
+    Creates the HTTP session shared by all the requests of a process, which keeps the connections to Flickr alive and
+    pooled so that the TLS handshake is done once per connection rather than once per request
+    :return: aiohttp client session
+    '''
+    timeout = aiohttp.ClientTimeout(total=config.http_total_timeout, connect=config.http_connect_timeout)
+    connector = aiohttp.TCPConnector(limit=config.http_max_connections,
+                                     limit_per_host=config.http_max_connections_per_host,
+                                     keepalive_timeout=config.http_keepalive_timeout, ttl_dns_cache=300)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers={'Accept-Encoding': 'gzip'})
 
 
-class NoDaemonProcess(multiprocessing.Process):
+def get_queued_batches(write_queue, timeout):
     '''
-    This class is used to set daemon property to false for a process which will allow to create sub processes.
-    By default, multiprocessing pool creates a daemon process and it cannot be overridden.
+    Waits for a batch of rows to be queued and takes it together with all the other batches already queued
+    :param write_queue: queue on which the batches are sent
+    :param timeout: maximum time in seconds to wait for a batch
+    :return: list of batches, empty if none was queued in time
     '''
+    try:
+        batches = [write_queue.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while True:
+        try:
+            batches.append(write_queue.get_nowait())
+        except queue.Empty:
+            return batches
+
 
-    def _get_daemon(self):
-        return False
+async def write_queued_data(dbutils, write_queue, no_of_producers):
+    '''
+    Writes the rows queued by the worker processes into database until each of them has queued None. It is the only
+    writer of the run, so writes never contend with each other for the SQLite write lock. The rows queued while a
+    write is in progress are written together with one transaction per table.
+    :param dbutils: DBUtils object owning the only write connection
+    :param write_queue: queue on which the worker processes send (table name, rows) batches
+    :param no_of_producers: number of worker processes queuing rows
+    '''
+    while no_of_producers:
+        # Waits in short steps so that the thread returns soon after the writer is cancelled
+        batches = await asyncio.to_thread(get_queued_batches, write_queue, 1)
+        rows_by_table = {}
+        for batch in batches:
+            if batch is None:
+                no_of_producers -= 1
+            else:
+                table_name, rows = batch
+                rows_by_table.setdefault(table_name, []).extend(rows)
+        for table_name, rows in rows_by_table.items():
+            await asyncio.to_thread(dbutils.insert_many, table_name, rows)
 
-    def _set_daemon(self, value):
-        pass
-    daemon = property(_get_daemon, _set_daemon)
+
+async def scrape_searches(search_texts, photos_per_page, no_of_processes=1, write_queue=None):
+    '''
+    Scrapes the images of the searches assigned to one of the worker processes concurrently, sharing one HTTP session
+    and the read connections between them. The rows to be inserted are sent to the writer on the write queue, followed
+    by None once the searches are over. The first search failing for good cancels the others and is raised as an
+    ExceptionGroup.
+    :param search_texts: list of texts to be searched
+    :param photos_per_page: number of photos to be retrieved at a time
+    :param no_of_processes: number of worker processes scraping at the same time
+    :param write_queue: queue on which the rows are sent to the writer
+    '''
+    scraper = WebScraper(search_texts, photos_per_page, no_of_processes, write_queue)
+    try:
+        async with create_session() as session, asyncio.TaskGroup() as tg:
+            for search_text in scraper.search_text_list:
+                tg.create_task(scraper.get_pages(session, search_text))
+    finally:
+        # Tells the writer that this process will not queue any more rows, even when a search failed
+        await asyncio.to_thread(scraper.write_queue.put, None)
+        scraper.close()
 
 
-class NoDaemonProcessPool(multiprocessing.pool.Pool):
+async def main(search_list, photos_per_page):
     '''
-    This class creates no daemon process that allows for creation of sub processes
+    Distributes the searches evenly across worker processes, each running its own event loop, while this process
+    writes the rows they queue into database
+    :param search_list: list of locations to be searched
+    :param photos_per_page: number of photos to be retrieved at a time
     '''
-    Process = NoDaemonProcess
+    search_texts = list(set(search_list))
+    processes = min(multiprocessing.cpu_count(), len(search_texts))
+    loop_initializer = uvloop.new_event_loop if uvloop else None
+    dbutils = db_utils.DBUtils(config.db_name)
+    try:
+        with multiprocessing.Manager() as manager:
+            write_queue = manager.Queue()
+            jobs = [(search_texts[i::processes], photos_per_page, processes, write_queue) for i in range(processes)]
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(write_queued_data(dbutils, write_queue, processes))
+                # The jobs share one queue, a worker running one job at a time leaves the other slices to the other
+                # workers instead of taking them all
+                async with Pool(processes=processes, childconcurrency=1,
+                                loop_initializer=loop_initializer) as process_pool:
+                    await process_pool.starmap(scrape_searches, jobs)
+    finally:
+        dbutils.close()
 
 
 if __name__ == '__main__':
@@ -206,16 +481,16 @@ if __name__ == '__main__':
     parser.add_argument('search_list', type=str, nargs='+', help='list of locations whose photos are to be searched on Flickr')
     parser.add_argument('--photos_per_page', type=int, default=500, help='number of photos to be retrieved at same time (max=500), limit set by Flickr')
     args = parser.parse_args()
-    scraper = WebScraper(args.search_list, args.photos_per_page)
     print('Creating needed tables')
-    scraper.dbutils.create_db_tables()
+    dbutils = db_utils.DBUtils(config.db_name)
+    dbutils.create_db_tables()
+    dbutils.close()
 
-    # Creates a pool of no daemon processes to allow for parallel searches of images and in turn creates sub processes
-    # to get the images metadata in parallel
+    # Spreads the searches over the processors, each process fetching its pages concurrently on an event loop, while
+    # this process is the only one writing into database
     print('Assigning jobs to multiple processors')
-    pool = NoDaemonProcessPool(scraper.no_of_processors_prop)
-    pool.map(scraper.get_pages, scraper.search_text_list)
-    pool.close()
-    pool.join()
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(main(args.search_list, args.photos_per_page))
     end = time.time()
     print('total time: ' + str(end-start))
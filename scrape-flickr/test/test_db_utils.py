@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from scrape_flickr import config
+from db_utils import DBUtils
+'''
+Unit testing for SQLite database operations
+Author: Shruti Rachh
+'''
+
+
+class TestDBUtils(unittest.TestCase):
+    '''
+    Tests for DBUtils class
+    '''
+
+    def setUp(self):
+        '''
+        Creates the tables in a temporary database for the unit tests
+        '''
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.test_db_utils = DBUtils(os.path.join(self.db_dir.name, 'test.db'))
+        self.test_db_utils.create_db_tables()
+
+    def tearDown(self):
+        '''
+        Closes the connections and deletes the temporary database
+        '''
+        self.test_db_utils.close()
+        self.db_dir.cleanup()
+
+    @patch.object(config, 'db_max_variables', 2)
+    def test_get_existing_keys(self):
+        rows = [(1, 'Paris', 48.864716, 2.349014), (3, 'Rome', 41.902782, 12.496366)]
+        self.test_db_utils.insert_many(config.image_metadata_table, rows)
+
+        # Test that the ids present in database are found even when the lookup is split into several queries
+        actual_result = self.test_db_utils.get_existing_keys(config.image_metadata_table, 'id', [1, 2, 3, 4])
+        self.assertEqual({1, 3}, actual_result)
+
+        # Test that no query is needed when there are no ids to look up
+        self.assertEqual(set(), self.test_db_utils.get_existing_keys(config.image_metadata_table, 'id', []))
+
+    def test_create_db_tables(self):
+        self.test_db_utils.insert_many(config.image_metadata_table, [(1, 'Paris', 48.864716, 2.349014)])
+        self.test_db_utils.insert_many(config.default_geo_info_table, [('paris', 48.864716, 2.349014)])
+
+        # Test that the image metadata of a previous run is cleared while the default geo locations are kept
+        self.test_db_utils.create_db_tables()
+        self.assertEqual([], self.test_db_utils.get_all(config.image_metadata_table))
+        self.assertEqual([('paris', 48.864716, 2.349014)], self.test_db_utils.get_all(config.default_geo_info_table))
+
+if __name__ == '__main__':
+    unittest.main()
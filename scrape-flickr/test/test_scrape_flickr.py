@@ -1,6 +1,11 @@
+import aiohttp
+import asyncio
+import queue
+import threading
+import time
 import unittest
-from unittest.mock import patch
-from scrape_flickr import WebScraper
+from unittest.mock import AsyncMock, MagicMock, patch
+from scrape_flickr import config, FlickrError, WebScraper, scrape_searches, write_queued_data
 '''
 Unit testing for web scraper library
 Author: Shruti Rachh
@@ -21,56 +26,225 @@ class TestWebScraper(unittest.TestCase):
 
     def tearDown(self):
         '''
-        Delete any objects created for unit tests
+        Release the geocoding threads and delete any objects created for unit tests
         '''
+        self.test_scraper.close()
         del self.test_scraper
 
-    @patch('db_utils.DBUtils.get_data')
-    @patch('db_utils.DBUtils.insert_data')
-    @patch('googlemaps.Client.geocode')
-    def test_get_missing_geo_data(self, google_maps_result, is_data_inserted, get_data_result):
-        expected_result = (self.search_text_list[0], '48.864716', '2.349014')
+    def get_no_matches(self, status_code):
+        '''
+        Creates a mock geocoder result that found no location
+        :param status_code: HTTP status code of the geocoding request
+        '''
+        no_matches = MagicMock(status_code=status_code)
+        no_matches.__bool__.return_value = False
+        return no_matches
+
+    @patch('asyncio.sleep', new_callable=AsyncMock)
+    @patch('db_utils.DBUtils.get_all')
+    @patch('geocoder.bing')
+    def test_get_missing_geo_data(self, bing_maps_result, get_all_result, sleep):
+        expected_result = (self.search_text_list[0], 48.864716, 2.349014)
 
-        # Test when default geo location is already inserted into database (if case)
-        get_data_result.return_value = [expected_result]
-        actual_result = self.test_scraper.get_missing_geo_data(self.search_text_list[0])
+        # Test when default geo location is already inserted into database and loaded into the cache (if case)
+        get_all_result.return_value = [expected_result]
+        actual_result = asyncio.run(self.test_scraper.get_missing_geo_data(self.search_text_list[0]))
         self.assertEqual(expected_result, actual_result)
 
-        # Test when geo location is obtained from mock Google Maps API (else case)
-        get_data_result.return_value = []
-        google_maps_result.return_value = [{
-            'geometry': {
-                'location': {
-                    'lat': 48.864716,
-                    'lng': 2.349014
-                }
-            }
-        }]
-        actual_result = self.test_scraper.get_missing_geo_data(self.search_text_list[0])
+        # Test that differently spelled search text is served from the cache without querying database again
+        actual_result = asyncio.run(self.test_scraper.get_missing_geo_data(' Paris '))
         self.assertEqual(expected_result, actual_result)
+        get_all_result.assert_called_once()
+        bing_maps_result.assert_not_called()
+
+        # Test that the pages starting together load the cache from database only once
+        async def get_missing_geo_data_of_pages(search_text):
+            return await asyncio.gather(*[self.test_scraper.get_missing_geo_data(search_text) for _ in range(3)])
+
+        self.test_scraper.geo_cache = None
+        get_all_result.reset_mock()
+        self.assertEqual([expected_result] * 3, asyncio.run(get_missing_geo_data_of_pages('paris')))
+        get_all_result.assert_called_once()
+
+        # Test when geo location is obtained from mock Bing Maps API (else case)
+        get_all_result.return_value = []
+        asyncio.run(self.test_scraper.load_geo_cache())
+        bing_maps_result.return_value = MagicMock(latlng=[48.864716, 2.349014])
+        actual_result = asyncio.run(self.test_scraper.get_missing_geo_data(self.search_text_list[0]))
+        self.assertEqual(expected_result, actual_result)
+        self.assertEqual(('default_geo_info', [expected_result]), self.test_scraper.write_queue.get_nowait())
 
         # Test when geo location cannot be obtained (pretty rare) in which case it returns empty tuple
-        get_data_result.return_value = []
-        google_maps_result.return_value = []
-        actual_result = self.test_scraper.get_missing_geo_data('par')
+        bing_maps_result.return_value = self.get_no_matches(200)
+        actual_result = asyncio.run(self.test_scraper.get_missing_geo_data('par'))
+        self.assertFalse(actual_result)
+        self.assertIn('par', self.test_scraper.geo_cache)
+
+        # Test that a location which could not be geocoded because Bing Maps kept failing is not cached
+        bing_maps_result.return_value = self.get_no_matches(503)
+        actual_result = asyncio.run(self.test_scraper.get_missing_geo_data('rom'))
         self.assertFalse(actual_result)
+        self.assertNotIn('rom', self.test_scraper.geo_cache)
+
+        # Test that the later pages do not go through the retries again until the failure expires
+        bing_maps_result.reset_mock()
+        self.assertFalse(asyncio.run(self.test_scraper.get_missing_geo_data('rom')))
+        bing_maps_result.assert_not_called()
+        with patch('time.monotonic', return_value=time.monotonic() + config.geocode_failure_ttl):
+            asyncio.run(self.test_scraper.get_missing_geo_data('rom'))
+        self.assertEqual(config.max_attempts, bing_maps_result.call_count)
+
+        # Test that the pages of a search missing the cache together share a single lookup
+        bing_maps_result.reset_mock(return_value=True)
+        bing_maps_result.return_value = MagicMock(latlng=[59.913868, 10.752245])
+        actual_result = asyncio.run(get_missing_geo_data_of_pages(' Oslo'))
+        self.assertEqual([('oslo', 59.913868, 10.752245)] * 3, actual_result)
+        bing_maps_result.assert_called_once()
+        self.assertFalse(self.test_scraper.geo_lookups)
+
+        # Test that different locations are geocoded at the same time on the geocoding threads
+        geocoding_together = threading.Barrier(2, timeout=5)
+
+        def geocode_together(search_text, key):
+            geocoding_together.wait()
+            return MagicMock(latlng=[48.864716, 2.349014])
+
+        async def get_missing_geo_data_of_searches():
+            return await asyncio.gather(*[self.test_scraper.get_missing_geo_data(text) for text in ['lyon', 'nice']])
+
+        bing_maps_result.side_effect = geocode_together
+        self.assertEqual([('lyon', 48.864716, 2.349014), ('nice', 48.864716, 2.349014)],
+                         asyncio.run(get_missing_geo_data_of_searches()))
+
+    @patch('asyncio.sleep', new_callable=AsyncMock)
+    @patch('geocoder.bing')
+    def test_geocode(self, bing_maps_result, sleep):
+        matches = MagicMock(latlng=[48.864716, 2.349014])
+
+        # Test that connection failures and server errors are retried until the location is geocoded
+        bing_maps_result.side_effect = [self.get_no_matches('Unknown'), self.get_no_matches(503), matches]
+        self.assertEqual(matches, asyncio.run(self.test_scraper.geocode(self.search_text_list[0])))
+        self.assertEqual(3, bing_maps_result.call_count)
+        self.assertEqual(2, sleep.call_count)
+
+        # Test that a location which is not found is not retried
+        bing_maps_result.reset_mock()
+        bing_maps_result.side_effect = [self.get_no_matches(200)]
+        self.assertFalse(asyncio.run(self.test_scraper.geocode('par')))
+        bing_maps_result.assert_called_once()
 
-    @patch('db_utils.DBUtils.get_data')
-    @patch('db_utils.DBUtils.insert_data')
+    @patch('db_utils.DBUtils.get_existing_keys')
     @patch('scrape_flickr.WebScraper.get_missing_geo_data')
-    def test_insert_image_metadata_db(self, missing_geo_data, is_data_inserted, get_data_result):
-        get_data_result.return_value = []
-        missing_geo_data.return_value = (self.search_text_list[0], '48.864716', '2.349014')
+    def test_insert_image_metadata_db(self, missing_geo_data, existing_keys):
+        existing_keys.return_value = {5678}
+        missing_geo_data.return_value = (self.search_text_list[0], 48.864716, 2.349014)
         photo = {
             'id': 1234,
             'title': 'Paris',
             'latitude': 0,
             'longitude': 0
         }
+        inserted_photo = {
+            'id': 5678,
+            'title': 'Eiffel Tower',
+            'latitude': 0,
+            'longitude': 0
+        }
         # Test to check whether correct image metadata is inserted into database especially geo info
-        self.test_scraper.insert_image_metadata_db(photo, self.search_text_list[0])
-        self.assertEqual('48.864716', photo['latitude'])
-        self.assertEqual('2.349014', photo['longitude'])
+        asyncio.run(self.test_scraper.insert_image_metadata_db([photo, inserted_photo], self.search_text_list[0]))
+        self.assertEqual(48.864716, photo['latitude'])
+        self.assertEqual(2.349014, photo['longitude'])
+
+        # Test that missing geo data is looked up once and photos already present in database are skipped
+        missing_geo_data.assert_called_once_with(self.search_text_list[0])
+        expected_batch = ('image_metadata', [(1234, 'Paris', 48.864716, 2.349014)])
+        self.assertEqual(expected_batch, self.test_scraper.write_queue.get_nowait())
+
+    @patch('db_utils.DBUtils.insert_many')
+    def test_write_queued_data(self, insert_many):
+        paris = (1234, 'Paris', 48.864716, 2.349014)
+        rome = (5678, 'Rome', 41.902782, 12.496366)
+        write_queue = queue.Queue()
+        for batch in [('image_metadata', [paris]), None, ('image_metadata', [rome]), None]:
+            write_queue.put_nowait(batch)
+
+        # Test that the batches queued while the writer was idle are written together until every process queued None
+        asyncio.run(write_queued_data(self.test_scraper.dbutils, write_queue, 2))
+        insert_many.assert_called_once_with('image_metadata', [paris, rome])
+
+    def get_session(self, *bodies):
+        '''
+        Creates a mock aiohttp session whose successive requests return the given response bodies with status 200
+        :param bodies: response bodies in bytes
+        '''
+        session = MagicMock()
+        resp = session.get.return_value.__aenter__.return_value
+        resp.status = 200
+        resp.raise_for_status = MagicMock()
+        resp.read = AsyncMock(side_effect=bodies)
+        return session
+
+    @patch('asyncio.sleep', new_callable=AsyncMock)
+    def test_fetch_page(self, sleep):
+        # Test that the photos part of a successful response is returned
+        session = self.get_session(b'{"photos": {"pages": 1, "photo": []}, "stat": "ok"}')
+        photos = asyncio.run(self.test_scraper.fetch_page(session, self.search_text_list[0]))
+        self.assertEqual({'pages': 1, 'photo': []}, photos)
+
+        # Test that an error reported by Flickr API is raised with its code and message
+        session = self.get_session(b'{"stat": "fail", "code": 100, "message": "Invalid API Key"}')
+        with self.assertRaises(FlickrError) as context:
+            asyncio.run(self.test_scraper.fetch_page(session, self.search_text_list[0]))
+        self.assertEqual(100, context.exception.code)
+        self.assertEqual('Invalid API Key', context.exception.message)
+
+        # Test that a connection dropped while reading the response and transient Flickr API errors are retried
+        ok_body = b'{"photos": {"pages": 1, "photo": []}, "stat": "ok"}'
+        unavailable_body = b'{"stat": "fail", "code": 105, "message": "Service currently unavailable"}'
+        session = self.get_session(aiohttp.ClientPayloadError('Response payload is not completed'), unavailable_body,
+                                   ok_body)
+        photos = asyncio.run(self.test_scraper.fetch_page(session, self.search_text_list[0]))
+        self.assertEqual({'pages': 1, 'photo': []}, photos)
+        self.assertEqual(3, session.get.call_count)
+
+    def test_get_search_params(self):
+        params = self.test_scraper.get_search_params(self.search_text_list[0], 2)
+
+        # Test that only the geo extras are requested as plain JSON without the JSONP callback wrapper
+        self.assertEqual('geo', params['extras'])
+        self.assertEqual('json', params['format'])
+        self.assertEqual(1, params['nojsoncallback'])
+        self.assertEqual(2, params['page'])
+
+    @patch('scrape_flickr.WebScraper.insert_image_metadata_db')
+    @patch('scrape_flickr.WebScraper.fetch_page', new_callable=AsyncMock)
+    def test_get_pages(self, fetch_page, insert_image_metadata_db):
+        fetch_page.side_effect = lambda session, search_text, page_no=1: {'pages': 3, 'photo': [{'id': page_no}]}
+
+        # Test that every page is processed and the first page is fetched only once
+        asyncio.run(self.test_scraper.get_pages(None, self.search_text_list[0]))
+        fetched_pages = sorted(call.args[2] if len(call.args) > 2 else 1 for call in fetch_page.call_args_list)
+        self.assertEqual([1, 2, 3], fetched_pages)
+        inserted_photos = sorted(call.args[0][0]['id'] for call in insert_image_metadata_db.call_args_list)
+        self.assertEqual([1, 2, 3], inserted_photos)
+
+    @patch('db_utils.DBUtils.insert_many')
+    @patch('scrape_flickr.WebScraper.get_pages')
+    def test_scrape_searches(self, get_pages, insert_many):
+        async def get_pages_result(session, search_text):
+            if search_text == 'rome':
+                raise ValueError('Flickr search failed')
+            await asyncio.sleep(60)
+
+        # Test that a failing search cancels the other searches, its error is propagated and the writer is told that
+        # the process is done, while the worker process never writes into database itself
+        get_pages.side_effect = get_pages_result
+        write_queue = queue.Queue()
+        with self.assertRaises(ExceptionGroup) as context:
+            asyncio.run(asyncio.wait_for(scrape_searches(['paris', 'rome'], 500, 1, write_queue), timeout=5))
+        self.assertIsNotNone(context.exception.subgroup(ValueError))
+        self.assertIsNone(write_queue.get_nowait())
+        insert_many.assert_not_called()
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file